@@ -1,14 +1,62 @@
 import argparse
+import bisect
+import functools
 import gzip
+import io
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
-import re
 import sys
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from multiprocessing import Pool
 from statistics import median
-from string import Template
-from typing import Dict, List, TypedDict, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+    Union,
+)
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pyarrow = None
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -24,8 +72,28 @@ CONFIG = {
     'LOGGING_FILE': None,
     'LOGGING_FORMAT': '[%(asctime)s] %(levelname).1s %(message)s',
     'NUMBER_ROUND_DEPTH': 3,
+    'WORKERS': os.cpu_count(),
+    'URL_SKETCH': False,
+    'EXACT_MEDIAN': False,
+    'ARROW': False,
 }
 
+RAPIDGZIP_BUFFER_SIZE = 512 * 1024
+GZIP_BUFFER_SIZE = 1024 * 1024
+REPORT_BUFFER_SIZE = 1024 * 1024
+PARSE_CHUNK_SIZE = 64 * 1024 * 1024
+ARROW_BLOCK_SIZE = 8 * 1024 * 1024
+URL_CARDINALITY_FILENAME = '.url_cardinality'
+URL_CARDINALITY_MAX = 10_000_000
+SKETCH_DEPTH = 4
+SKETCH_MIN_WIDTH = 1 << 16
+SKETCH_MAX_WIDTH = 1 << 22
+# P² keeps raw values and gives exact median until this count
+P2_EXACT_SIZE = 1024
+
+# log filename is prefix, date as YYYYMMDD and extension
+LOG_FILENAME_PREFIX = 'nginx-access-ui.log-'
+
 Config = TypedDict(
     'Config',
     REPORT_SIZE=int,
@@ -36,6 +104,10 @@ Config = TypedDict(
     LOGGING_FILE=Union[str, None],
     LOGGING_FORMAT=str,
     NUMBER_ROUND_DEPTH=int,
+    WORKERS=int,
+    URL_SKETCH=bool,
+    EXACT_MEDIAN=bool,
+    ARROW=bool,
 )
 
 Fileinfo = TypedDict(
@@ -45,31 +117,12 @@ Fileinfo = TypedDict(
     extension=str,
 )
 
-ParsedLine = TypedDict(
-    'ParsedLine',
-    remote_addr=str,
-    remote_user=str,
-    http_x_real_ip=str,
-    time_local=str,
-    method=str,
-    url=str,
-    protocol=str,
-    status=str,
-    body_bytes_sent=str,
-    http_referer=str,
-    http_user_agent=str,
-    http_x_forwarded_for=str,
-    http_X_REQUEST_ID=str,
-    http_X_RB_USER=str,
-    request_time=float,
-)
+# (url, request_time)
+ParsedLine = Tuple[str, float]
 
-ParsedLog = TypedDict(
-    'ParsedLog',
-    total_count=int,
-    total_time=float,
-    parsed_lines=List[ParsedLine],
-)
+# P² median estimator: marker heights and marker positions,
+# heights keep raw values in array('d') until P2_EXACT_SIZE values are collected
+P2State = List[Union[array, List[float]]]
 
 ProcessedLine = TypedDict(
     'ProcessedLine',
@@ -78,9 +131,15 @@ ProcessedLine = TypedDict(
     time_sum=float,
     time_avg=float,
     time_max=float,
-    time_list=List[float],
+    time_med=float,
 )
 
+# per url accumulator of hot loop, index access is cheaper than dict keys:
+# [count, time_sum, time_max, time_med_state], time_med_state is P2State
+# or array('d') of all request times with EXACT_MEDIAN
+UrlStats = list
+
+
 ProcessedLog = TypedDict(
     'ProcessedLog',
     total_count=int,
@@ -148,171 +207,708 @@ def generate_report_filename(
     return fileinfo
 
 
-def find_log(
-    *,
-    config: Config,
-    logger: logging.Logger,
-) -> Fileinfo:
-    filename_pattern = re.compile(r'nginx-access-ui\.log-(\d{8})')
-    date_format = '%Y%m%d'
+def scan_log_dir(
+    log_dir: str,
+    formats: Sequence[str],
+) -> Optional[Tuple[str, datetime, str]]:
+    """Filename, date and extension of last log in dir, None if there is no log"""
+    prefix_len = len(LOG_FILENAME_PREFIX)
     last_date = None
     log_filename = ''
+    log_extension = ''
 
-    for filename in os.listdir(config['LOG_DIR']):
-        matched = filename_pattern.match(filename)
-        if matched:
-            _, extension = os.path.splitext(filename)
-            if extension not in config['SUPPORTED_LOG_FORMATS']:
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith(LOG_FILENAME_PREFIX):
+                continue
+
+            # fixed name format, so date and extension are taken by position
+            date_str, extension = name[prefix_len:prefix_len + 8], name[prefix_len + 8:]
+            if extension not in formats or len(date_str) != 8:
+                continue
+            if not (date_str.isascii() and date_str.isdigit()):
                 continue
 
-            date_str = matched.groups()[0]
             try:
-                date = datetime.strptime(date_str, date_format)
+                date = datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:]))
             except ValueError:
                 continue
 
-            if not last_date or date > last_date:
+            if (not last_date or date > last_date) and entry.is_file():
                 last_date = date
-                log_filename = filename
+                log_filename = name
+                log_extension = extension
 
     if not last_date:
+        return None
+    return log_filename, last_date, log_extension
+
+
+def find_log(
+    *,
+    config: Config,
+    logger: logging.Logger,
+) -> Fileinfo:
+    log_dir = config['LOG_DIR']
+    last_log = scan_log_dir(log_dir, config['SUPPORTED_LOG_FORMATS'])
+    if not last_log:
         logger.warning('Log not founded, check `LOG_DIR` in config')
         raise SystemExit()
 
-    _, extension = os.path.splitext(log_filename)
+    log_filename, last_date, log_extension = last_log
     log_fileinfo = Fileinfo(
-        path=os.path.join(config['LOG_DIR'], log_filename),
+        path=os.path.join(log_dir, log_filename),
         date=last_date,
-        extension=extension,
+        extension=log_extension,
     )
     return log_fileinfo
 
 
-def check_is_exist_report(
+def is_exist_report(
     *,
     config: Config,
     log_fileinfo: Fileinfo,
     logger: logging.Logger,
-) -> None:
+) -> bool:
     report_fileinfo = generate_report_filename(config=config, log_fileinfo=log_fileinfo)
     if os.path.exists(report_fileinfo['path']):
         logger.warning(f'Report already generated, check {report_fileinfo["path"]}')
-        raise SystemExit()
+        return True
+    return False
 
 
-def parse_log(
+def check_is_exist_report(
     *,
     config: Config,
     log_fileinfo: Fileinfo,
     logger: logging.Logger,
-) -> ParsedLog:
-    parsed_log = ParsedLog(
-        total_count=0,
-        total_time=0.0,
-        parsed_lines=[],
-    )
+) -> None:
+    if is_exist_report(config=config, log_fileinfo=log_fileinfo, logger=logger):
+        raise SystemExit()
 
-    log_pattern = re.compile(
-        r'(\S+) (\S+)  (\S+) \[(.*)\] "(\S+) (\S+) (\S+) (\S+) (\S+) "(\S+)" "(.*?)" "(\S+)" "(\S+)" "(\S+)" (\S+)'
-    )
-    colnames = (
-        'remote_addr',
-        'remote_user',
-        'http_x_real_ip',
-        'time_local',
-        'method',
-        'url',
-        'protocol',
-        'status',
-        'body_bytes_sent',
-        'http_referer',
-        'http_user_agent',
-        'http_x_forwarded_for',
-        'http_X_REQUEST_ID',
-        'http_X_RB_USER',
-        'request_time',
-    )
 
-    openers = {'.gz': gzip.open, '': open}
-    opener = openers.get(log_fileinfo['extension'], open)
-    lines = (line for line in opener(log_fileinfo['path'], mode='rt'))
+def load_url_cardinality(
+    *,
+    config: Config,
+) -> int:
+    """Count of unique urls saved by previous run, 0 on first run"""
+    path = os.path.join(config['REPORT_DIR'], URL_CARDINALITY_FILENAME)
+    try:
+        with open(path) as f:
+            return min(int(f.read()), URL_CARDINALITY_MAX)
+    except (OSError, ValueError):
+        return 0
+
+
+def save_url_cardinality(
+    *,
+    config: Config,
+    cardinality: int,
+) -> None:
+    path = os.path.join(config['REPORT_DIR'], URL_CARDINALITY_FILENAME)
+    try:
+        with open(path, 'w') as f:
+            f.write(str(cardinality))
+    except OSError:
+        pass
+
+
+@contextmanager
+def open_gz(path: str) -> Iterator[BinaryIO]:
+    """Open gzip log for binary read, decompress in parallel with rapidgzip if it is installed
+
+    Otherwise ISA-L igzip (SIMD inflate) or stdlib gzip is used, they read
+    compressed data by small pieces, so they get file with large buffer.
+    """
+    if rapidgzip is None:
+        gzip_module = igzip or gzip
+        with open(path, 'rb', buffering=GZIP_BUFFER_SIZE) as raw, gzip_module.open(raw, mode='rb') as f:
+            yield f
+        return
+
+    raw = rapidgzip.RapidgzipFile(path, parallelization=os.cpu_count())
+    with io.BufferedReader(raw, buffer_size=RAPIDGZIP_BUFFER_SIZE) as buffered:
+        yield buffered
+
+
+def p2_init(value: float) -> P2State:
+    return [array('d', (value,)), []]
+
+
+def p2_start(state: P2State) -> None:
+    """Switch estimator from raw values to five markers at exact quantiles"""
+    values = sorted(state[0])
+    size = len(values)
+    positions = [1 + round(i * (size - 1) / 4) for i in range(5)]
+    state[0] = [values[position - 1] for position in positions]
+    state[1] = positions
+
+
+def p2_update(state: P2State, value: float) -> None:
+    """Add value to P² median estimator (Jain & Chlamtac), O(1) memory
+
+    First P2_EXACT_SIZE values are kept as is, so median of rare url is exact.
+    """
+    heights, positions = state
+    if not positions:
+        heights.append(value)
+        if len(heights) >= P2_EXACT_SIZE:
+            p2_start(state)
+        return
+
+    if value < heights[0]:
+        heights[0] = value
+        k = 0
+    elif value >= heights[4]:
+        heights[4] = value
+        k = 3
+    else:
+        k = bisect.bisect_right(heights, value, 1, 4) - 1
+
+    for i in range(k + 1, 5):
+        positions[i] += 1
+
+    step = (positions[4] - 1) / 4
+    for i in (1, 2, 3):
+        delta = 1 + i * step - positions[i]
+        if (delta >= 1 and positions[i + 1] - positions[i] > 1) or (
+                delta <= -1 and positions[i - 1] - positions[i] < -1):
+            d = 1 if delta > 0 else -1
+            height = heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+                (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i]) /
+                (positions[i + 1] - positions[i]) +
+                (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1]) /
+                (positions[i] - positions[i - 1]))
+            if not heights[i - 1] < height < heights[i + 1]:
+                height = heights[i] + d * (heights[i + d] - heights[i]) / (
+                    positions[i + d] - positions[i])
+            heights[i] = height
+            positions[i] += d
+
+
+def p2_merge(state: P2State, other: P2State) -> None:
+    """Merge other estimator into state
+
+    Exact while one of them still keeps raw values, otherwise marker heights
+    are averaged by weight, so result is an approximation.
+    """
+    if not other[1]:
+        for value in other[0]:
+            p2_update(state, value)
+        return
+
+    if not state[1]:
+        values = state[0]
+        state[0], state[1] = list(other[0]), list(other[1])
+        for value in values:
+            p2_update(state, value)
+        return
+
+    heights, positions = state
+    other_heights, other_positions = other
+    weight, other_weight = positions[4], other_positions[4]
+    for i in (1, 2, 3):
+        heights[i] = (heights[i] * weight + other_heights[i] * other_weight) / (weight + other_weight)
+        positions[i] += other_positions[i]
+    heights[0] = min(heights[0], other_heights[0])
+    heights[4] = max(heights[4], other_heights[4])
+    positions[4] = weight + other_weight
+
+
+def p2_value(state: P2State) -> float:
+    heights, positions = state
+    if not positions:
+        return median(heights)
+    return heights[2]
+
+
+def parse_line(line: bytes) -> Optional[ParsedLine]:
+    """Get url and request_time from ui_short log line, None for malformed line
+
+    Format is fixed, so positional search is used instead of regex:
+    url is second field of quoted request, request_time is last field.
+    Line stays bytes, only url is decoded.
+    """
+    request_start = line.find(b'] "')
+    if request_start == -1:
+        return None
+
+    request_start += 3
+    request_end = line.find(b'"', request_start)
+    request = line[request_start:request_end].split(b' ')
+    if request_end == -1 or len(request) != 3:
+        return None
+
+    try:
+        return request[1].decode(), float(line.rpartition(b' ')[2])
+    except ValueError:
+        return None
+
+
+def exact_init(value: float) -> array:
+    return array('d', (value,))
+
+
+def exact_median(values: Sequence[float]) -> float:
+    """Median by selection in O(n) with numpy, by sorting without it
+
+    array('d') is viewed by numpy without copy, plain list is accepted too.
+    """
+    if numpy is None:
+        return median(values)
+
+    size = len(values)
+    middle = size // 2
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if size % 2:
+        return float(numpy.partition(values, middle)[middle])
+
+    selected = numpy.partition(values, (middle - 1, middle))
+    return float(selected[middle - 1] + selected[middle]) / 2
+
+
+def iter_chunks(f: BinaryIO, size: int) -> Iterator[bytes]:
+    """Read file by chunks of ~size bytes, every chunk ends on a line boundary"""
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk + f.readline()
+
+
+def iter_chunk_bounds(mm: Union[mmap.mmap, bytes], size: int) -> Iterator[Tuple[int, int]]:
+    """Offsets of ~size bytes chunks of mapped file, every chunk ends on a line boundary"""
+    start = 0
+    file_size = len(mm)
+    while start < file_size:
+        end = mm.find(b'\n', start + size - 1)
+        end = file_size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+@contextmanager
+def open_mmap(path: str) -> Iterator[Union[mmap.mmap, bytes]]:
+    """Read-only map of file, empty bytes for empty file as it cannot be mapped"""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b''
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            yield mm
+
+
+def apply_to_mapped_chunk(
+    bounds: Tuple[int, int],
+    *,
+    path: str,
+    func: Callable[[bytes], Any],
+) -> Any:
+    """Apply func to chunk of plain log, chunk is sliced from page cache without read calls"""
+    start, end = bounds
+    with open_mmap(path) as mm:
+        return func(mm[start:end])
+
+
+def sketch_width(url_cardinality: int) -> int:
+    width = SKETCH_MIN_WIDTH
+    while width < url_cardinality and width < SKETCH_MAX_WIDTH:
+        width <<= 1
+    return width
+
+
+def sketch_cardinality(sketch: array) -> int:
+    """Unique urls estimated by linear counting of empty counters in first lane"""
+    width = len(sketch) // SKETCH_DEPTH
+    empty = sketch[:width].count(0.0)
+    if not empty:
+        return URL_CARDINALITY_MAX
+    return min(round(-width * math.log(empty / width)), URL_CARDINALITY_MAX)
+
+
+def sketch_indexes(url: str, width: int) -> List[int]:
+    """Counter index of url in every lane of count-min sketch, double hashing"""
+    url_bytes = url.encode()
+    hash1 = zlib.crc32(url_bytes)
+    hash2 = zlib.adler32(url_bytes) | 1
+    return [lane * width + (hash1 + lane * hash2) % width for lane in range(SKETCH_DEPTH)]
+
+
+def sum_chunk_times(chunk: bytes) -> Dict[str, float]:
+    """Sum of request_time by url for one chunk, runs in worker processes
+
+    Only urls of chunk are sent back, whole sketch never goes through pool pipes.
+    """
+    times = {}
+    for line in chunk.split(b'\n'):
+        parsed_line = parse_line(line)
+        if parsed_line is None:
+            continue
+
+        url, request_time = parsed_line
+        times[url] = times.get(url, 0.0) + request_time
+    return times
+
+
+def add_to_sketch(sketch: array, times: Dict[str, float]) -> None:
+    """Add sums of request_time by url to count-min sketch"""
+    width = len(sketch) // SKETCH_DEPTH
+    for url, time_sum in times.items():
+        for i in sketch_indexes(url, width):
+            sketch[i] += time_sum
+
+
+def parse_chunk(
+    chunk: bytes,
+    *,
+    logger: logging.Logger,
+    sketch: Optional[array] = None,
+    threshold: float = 0.0,
+    exact: bool = False,
+) -> Tuple[Dict[str, UrlStats], int, int]:
+    """Aggregate lines of one chunk, runs in worker processes
+
+    With sketch, urls which sketch estimate of time_sum is below threshold are
+    not stored, count-min never underestimates, so no reported url is lost.
+    Returns partial data by url, count of lines and count of skipped lines
+    """
+    width = len(sketch) // SKETCH_DEPTH if sketch else 0
+    median_init, median_update = (exact_init, array.append) if exact else (p2_init, p2_update)
+    tmp_data = {}
     count = 0
     terminated_count = 0
+    lines = chunk.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+
     for line in lines:
         count += 1
-        try:
-            groups = log_pattern.match(line).groups()
-        except AttributeError:
-            logger.info(f'Skiped line: {line}')
+        parsed_line = parse_line(line)
+        if parsed_line is None:
+            logger.info(f'Skiped line: {line.decode(errors="replace")}')
             terminated_count += 1
             continue
 
-        if terminated_count * 100 / count >= config['TERMINATED_PERCENT']:
-            logger.exception(f'Error: TERMINATED_PERCENT achieved, parsing is stopped')
-            raise SystemExit()
+        url, request_time = parsed_line
+        url_stats = tmp_data.get(url)
+        if url_stats is None:
+            if sketch and min(sketch[i] for i in sketch_indexes(url, width)) < threshold:
+                continue
+            tmp_data[url] = [1, request_time, request_time, median_init(request_time)]
+            continue
 
-        parsed_dict = dict(zip(colnames, groups))
-        parsed_dict['request_time'] = float(parsed_dict['request_time'])
-        parsed_line = ParsedLine(**parsed_dict)
-        parsed_log['total_count'] += 1
-        parsed_log['total_time'] += float(parsed_line['request_time'])
-        parsed_log['parsed_lines'].append(parsed_line)
+        url_stats[0] += 1
+        url_stats[1] += request_time
+        if request_time > url_stats[2]:
+            url_stats[2] = request_time
+        median_update(url_stats[3], request_time)
 
-    return parsed_log
+    return tmp_data, count, terminated_count
 
 
-def process_log(
+# sketch of URL_SKETCH second pass, set once in every worker process by Pool initializer
+worker_sketch: Optional[array] = None
+
+
+def init_worker_sketch(sketch: array) -> None:
+    global worker_sketch
+    worker_sketch = sketch
+
+
+def parse_chunk_with_worker_sketch(chunk: bytes, **kwargs: Any) -> Tuple[Dict[str, UrlStats], int, int]:
+    return parse_chunk(chunk, sketch=worker_sketch, **kwargs)
+
+
+def merge_tmp_data(
+    tmp_data: Dict[str, UrlStats],
+    partial_data: Dict[str, UrlStats],
+    *,
+    exact: bool = False,
+) -> None:
+    if not tmp_data:
+        # copy of whole dict table, no per-key inserts and resizes
+        tmp_data.update(partial_data)
+        return
+
+    for url, partial_stats in partial_data.items():
+        url_stats = tmp_data.get(url)
+        if url_stats is None:
+            tmp_data[url] = partial_stats
+            continue
+
+        url_stats[0] += partial_stats[0]
+        url_stats[1] += partial_stats[1]
+        if partial_stats[2] > url_stats[2]:
+            url_stats[2] = partial_stats[2]
+        if exact:
+            url_stats[3].extend(partial_stats[3])
+        else:
+            p2_merge(url_stats[3], partial_stats[3])
+
+
+def check_terminated_percent(
     *,
     config: Config,
-    parsed_log: ParsedLog,
-) -> ProcessedLog:
+    count: int,
+    terminated_count: int,
+    logger: logging.Logger,
+) -> None:
+    if count and terminated_count * 100 / count >= config['TERMINATED_PERCENT']:
+        logger.exception(f'Error: TERMINATED_PERCENT achieved, parsing is stopped')
+        raise SystemExit()
+
+
+def map_chunks(
+    *,
+    config: Config,
+    log_fileinfo: Fileinfo,
+    func: Callable[[bytes], Any],
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple = (),
+) -> Iterator[Any]:
+    """Apply func to every chunk of log, in worker processes if WORKERS > 1
+
+    initializer is called with initargs once in every worker process, data
+    shared by all chunks is sent this way instead of with every chunk.
+
+    Plain log is mapped to memory: only chunk offsets are sent to workers and
+    every worker slices its chunk itself. Gzipped log is decompressed here and
+    chunks are sent as bytes.
+    """
+    path = log_fileinfo['path']
+    workers = config['WORKERS'] or 1
+    with Pool(workers, initializer, initargs) if workers > 1 else nullcontext() as pool:
+        if log_fileinfo['extension'] != '.gz':
+            with open_mmap(path) as mm:
+                bounds = list(iter_chunk_bounds(mm, PARSE_CHUNK_SIZE))
+            func = functools.partial(apply_to_mapped_chunk, path=path, func=func)
+            yield from pool.imap_unordered(func, bounds) if pool else map(func, bounds)
+            return
+
+        with open_gz(path) as f:
+            chunks = iter_chunks(f, PARSE_CHUNK_SIZE)
+            while True:
+                # feed pool by batches, so whole log is never read into memory
+                batch = list(itertools.islice(chunks, workers))
+                if not batch:
+                    break
+
+                yield from pool.imap_unordered(func, batch) if pool else map(func, batch)
+
+
+def build_url_sketch(
+    *,
+    config: Config,
+    log_fileinfo: Fileinfo,
+) -> array:
+    width = sketch_width(load_url_cardinality(config=config))
+    sketch = array('d', bytes(8 * SKETCH_DEPTH * width))
+    for times in map_chunks(config=config, log_fileinfo=log_fileinfo, func=sum_chunk_times):
+        add_to_sketch(sketch, times)
+    return sketch
+
+
+def aggregate_log(
+    *,
+    config: Config,
+    log_fileinfo: Fileinfo,
+    logger: logging.Logger,
+) -> Dict[str, ProcessedLine]:
+    """Parse and aggregate log in pure python
+
+    With URL_SKETCH log is read twice: first pass builds count-min sketch of
+    time_sum by url, second pass stores only urls that can reach REPORT_SIZE.
+    Result is exact, memory is traded for time. Unique urls count estimated
+    by sketch is saved, next run picks sketch width by it.
+    Returns urls that reach REPORT_SIZE.
+    """
     tmp_data = {}
+    count = 0
+    terminated_count = 0
+
+    sketch = None
+    if config['URL_SKETCH']:
+        sketch = build_url_sketch(config=config, log_fileinfo=log_fileinfo)
+        save_url_cardinality(config=config, cardinality=sketch_cardinality(sketch))
+    parse_options = dict(logger=logger, threshold=config['REPORT_SIZE'], exact=config['EXACT_MEDIAN'])
+    initializer, initargs = None, ()
+    if sketch is not None and (config['WORKERS'] or 1) > 1:
+        # sketch is sent once to every worker, not pickled with every chunk
+        func = functools.partial(parse_chunk_with_worker_sketch, **parse_options)
+        initializer, initargs = init_worker_sketch, (sketch,)
+    else:
+        func = functools.partial(parse_chunk, sketch=sketch, **parse_options)
+    partials = map_chunks(
+        config=config,
+        log_fileinfo=log_fileinfo,
+        func=func,
+        initializer=initializer,
+        initargs=initargs,
+    )
+    for partial_data, partial_count, partial_terminated_count in partials:
+        merge_tmp_data(tmp_data, partial_data, exact=config['EXACT_MEDIAN'])
+        count += partial_count
+        terminated_count += partial_terminated_count
+        check_terminated_percent(
+            config=config,
+            count=count,
+            terminated_count=terminated_count,
+            logger=logger,
+        )
+
+    # median is the costly part, so it is computed only for reported urls
+    median_value = exact_median if config['EXACT_MEDIAN'] else p2_value
+    data = {
+        url: ProcessedLine(
+            url=url,
+            count=url_stats[0],
+            time_sum=url_stats[1],
+            time_max=url_stats[2],
+            time_med=median_value(url_stats[3]),
+        )
+        for url, url_stats in tmp_data.items()
+        if url_stats[1] >= config['REPORT_SIZE']
+    }
+    return data
+
+
+def is_utf8_bytes(value: bytes) -> bool:
+    try:
+        value.decode()
+    except UnicodeDecodeError:
+        return False
+    return True
 
-    parsed_lines = (parsed_line for parsed_line in parsed_log['parsed_lines'])
-    for parsed_line in parsed_lines:
-        url = parsed_line['url']
-        processed_line = tmp_data.get(url, None)
-        if not processed_line:
-            processed_line = ProcessedLine(
-                url=url,
-                count=0,
-                time_sum=0.0,
-                time_max=0.0,
-                time_list=[],
-            )
-
-        processed_line['count'] += 1
-        request_time = parsed_line['request_time']
-        processed_line['time_sum'] += request_time
-        processed_line['time_list'].append(request_time)
-        if request_time > processed_line['time_max']:
-            processed_line['time_max'] = request_time
-
-        tmp_data[url] = processed_line
+
+def aggregate_log_arrow(
+    *,
+    config: Config,
+    log_fileinfo: Fileinfo,
+    logger: logging.Logger,
+) -> Dict[str, ProcessedLine]:
+    """Parse and aggregate log with pyarrow, all per-line work runs in C
+
+    Log is read as space delimited csv with quoted fields, ui_short has 15 such
+    columns: request is 7th, request_time is last. Median is t-digest estimate.
+    Parsed columns of whole log are kept until group by, so memory grows with
+    log size, WORKERS and gzip backends are not used.
+    """
+    count = 0
+    terminated_count = 0
+
+    def skip_row(row) -> str:
+        nonlocal count, terminated_count
+        logger.info(f'Skiped line: {row.text}')
+        count += 1
+        terminated_count += 1
+        return 'skip'
+
+    column_names = [f'column_{i}' for i in range(15)]
+    request_column, request_time_column = column_names[6], column_names[14]
+    compression = 'gzip' if log_fileinfo['extension'] == '.gz' else None
+    reader = pacsv.open_csv(
+        pyarrow.input_stream(log_fileinfo['path'], compression=compression),
+        read_options=pacsv.ReadOptions(column_names=column_names, block_size=ARROW_BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(
+            delimiter=' ',
+            quote_char='"',
+            invalid_row_handler=skip_row,
+        ),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[request_column, request_time_column],
+            # binary, so non utf-8 line is skipped as malformed instead of failing whole read
+            column_types={request_column: pyarrow.binary(), request_time_column: pyarrow.binary()},
+        ),
+    )
+
+    tables = []
+    for batch in reader:
+        request = pc.split_pattern(batch.column(request_column), ' ')
+        request_time = batch.column(request_time_column)
+        is_valid = pc.and_(
+            pc.equal(pc.list_value_length(request), 3),
+            pc.match_substring_regex(request_time, r'^\d+(\.\d*)?$'),
+        )
+        url = pc.list_element(pc.filter(request, is_valid), 1)
+        request_time = pc.filter(request_time, is_valid)
+        try:
+            url = pc.cast(url, pyarrow.string())
+        except pyarrow.ArrowInvalid:
+            # batch has non utf-8 url, only here urls are checked one by one
+            is_utf8 = pyarrow.array([is_utf8_bytes(value) for value in url.to_pylist()])
+            url = pc.cast(pc.filter(url, is_utf8), pyarrow.string())
+            request_time = pc.filter(request_time, is_utf8)
+
+        count += batch.num_rows
+        terminated_count += batch.num_rows - len(url)
+        check_terminated_percent(
+            config=config,
+            count=count,
+            terminated_count=terminated_count,
+            logger=logger,
+        )
+        tables.append(pyarrow.table({'url': url, 'request_time': pc.cast(request_time, pyarrow.float64())}))
+
+    if not tables:
+        return {}
+
+    aggregated = pyarrow.concat_tables(tables).group_by('url').aggregate([
+        ('request_time', 'count'),
+        ('request_time', 'sum'),
+        ('request_time', 'max'),
+        ('request_time', 'tdigest'),
+    ])
+    is_reported = pc.greater_equal(aggregated['request_time_sum'], config['REPORT_SIZE'])
+    data = {}
+    for row in aggregated.filter(is_reported).to_pylist():
+        data[row['url']] = ProcessedLine(
+            url=row['url'],
+            count=row['request_time_count'],
+            time_sum=row['request_time_sum'],
+            time_max=row['request_time_max'],
+            time_med=row['request_time_tdigest'][0],
+        )
+    return data
+
+
+def parse_and_aggregate(
+    *,
+    config: Config,
+    log_fileinfo: Fileinfo,
+    logger: logging.Logger,
+) -> ProcessedLog:
+    aggregate = aggregate_log
+    if config['ARROW']:
+        if pyarrow is None:
+            logger.warning('ARROW is set, but pyarrow is not installed, pure python is used')
+        elif config['EXACT_MEDIAN'] or config['URL_SKETCH']:
+            logger.warning('EXACT_MEDIAN and URL_SKETCH need pure python, ARROW is ignored')
+        else:
+            aggregate = aggregate_log_arrow
+    data = aggregate(config=config, log_fileinfo=log_fileinfo, logger=logger)
 
     processed_log = ProcessedLog(
         total_count=0,
         total_time=0.0,
-        data={},
+        data=data,
     )
 
-    for url, processed_line in tmp_data.items():
-        if processed_line['time_sum'] >= config['REPORT_SIZE']:
-            processed_log['total_count'] += processed_line['count']
-            processed_log['total_time'] += processed_line['time_sum']
-            processed_log['data'][url] = processed_line
+    for processed_line in data.values():
+        processed_log['total_count'] += processed_line['count']
+        processed_log['total_time'] += processed_line['time_sum']
 
     return processed_log
 
 
-def generate_report(
+def iter_report_rows(
     *,
     config: Config,
     processed_log: ProcessedLog,
-    log_fileinfo: Fileinfo,
-    logger: logging.Logger,
-) -> None:
-    table_list = []
+) -> Iterator[dict]:
     nrd = config['NUMBER_ROUND_DEPTH']
 
     for url, processed_line in processed_log['data'].items():
@@ -320,38 +916,114 @@ def generate_report(
         time_sum = round(processed_line['time_sum'], nrd)
         time_perc = round(processed_line['time_sum'] * 100 / processed_log['total_time'], nrd)
         time_avg = round(processed_line['time_sum'] / processed_line['count'], nrd)
-        time_med = round(median(processed_line['time_list']), nrd)
+        time_med = round(processed_line['time_med'], nrd)
         time_max = round(processed_line['time_max'], nrd)
-        table_list.append(
-            {
-                'url': url,
-                'count': processed_line['count'],
-                'count_perc': count_perc,
-                'time_sum': time_sum,
-                'time_perc': time_perc,
-                'time_avg': time_avg,
-                'time_max': time_max,
-                'time_med': time_med,
-            })
-
-    table_json = json.dumps(table_list)
+        yield {
+            'url': url,
+            'count': processed_line['count'],
+            'count_perc': count_perc,
+            'time_sum': time_sum,
+            'time_perc': time_perc,
+            'time_avg': time_avg,
+            'time_max': time_max,
+            'time_med': time_med,
+        }
+
+
+def dump_json(obj: Any) -> bytes:
+    """Compact json, serialized in C by orjson if it is installed"""
+    if orjson is None:
+        return json.dumps(obj, separators=(',', ':')).encode()
+    return orjson.dumps(obj)
+
+
+def generate_report(
+    *,
+    config: Config,
+    processed_log: ProcessedLog,
+    log_fileinfo: Fileinfo,
+    logger: logging.Logger,
+) -> None:
     report_template_path = os.path.join(config['REPORT_DIR'], 'report.html')
     if not os.path.exists(report_template_path):
         logger.exception('Error: Report template (report.html) not found in REPORT_DIR')
         raise SystemExit()
 
-    with open(report_template_path) as f:
-        report_template = Template(f.read())
-        report_render = report_template.safe_substitute(table_json=table_json)
+    with open(report_template_path, 'rb') as f:
+        report_prefix, marker, report_suffix = f.read().partition(b'$table_json')
+
+    if not marker:
+        logger.exception('Error: $table_json not found in report template')
+        raise SystemExit()
 
     report_fileinfo = generate_report_filename(config=config, log_fileinfo=log_fileinfo)
-    with open(report_fileinfo['path'], 'w') as f:
-        f.write(report_render)
+    with open(report_fileinfo['path'], 'wb', buffering=REPORT_BUFFER_SIZE) as f:
+        # rows are serialized one by one, table json is never built as a whole,
+        # small writes are batched by the large buffer
+        f.write(report_prefix)
+        f.write(b'[')
+        rows = iter_report_rows(config=config, processed_log=processed_log)
+        for i, row in enumerate(rows):
+            if i:
+                f.write(b',')
+            f.write(dump_json(row))
+        f.write(b']')
+        f.write(report_suffix)
 
     logger.info(f'Success: report ready: {report_fileinfo["path"]}')
     return
 
 
+def process_one(
+    log_fileinfo: Fileinfo,
+    *,
+    config: Config,
+    logger: logging.Logger,
+) -> Fileinfo:
+    """Parse, aggregate and write report of one log, returns report fileinfo
+
+    Report is written by the worker itself, so only its fileinfo is sent back.
+    """
+    processed_log = parse_and_aggregate(config=config, log_fileinfo=log_fileinfo, logger=logger)
+    generate_report(
+        config=config,
+        processed_log=processed_log,
+        log_fileinfo=log_fileinfo,
+        logger=logger,
+    )
+    return generate_report_filename(config=config, log_fileinfo=log_fileinfo)
+
+
+def process_many(
+    *,
+    config: Config,
+    log_fileinfos: Sequence[Fileinfo],
+    logger: logging.Logger,
+) -> Iterator[Fileinfo]:
+    """Reports of several logs, one log per worker process
+
+    Logs with already generated report are skipped. Every log is parsed in
+    a single process, so workers do not spawn nested pools.
+    """
+    pending = [
+        log_fileinfo for log_fileinfo in log_fileinfos
+        if not is_exist_report(config=config, log_fileinfo=log_fileinfo, logger=logger)
+    ]
+
+    if not pending:
+        return
+
+    workers = min(config['WORKERS'] or 1, len(pending))
+    worker_config: Config = {**config, 'WORKERS': 1}
+    func = functools.partial(process_one, config=worker_config, logger=logger)
+    if workers == 1:
+        yield from map(func, pending)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(func, pending, chunksize=1)
+
+
 def main():
     """Log Analyzer
 
@@ -361,9 +1033,8 @@ def main():
     3. Setup logger
     4. Find log
     5. Check already generated report
-    6. Parse log
-    7. Process log
-    8. Generate report
+    6. Parse and aggregate log
+    7. Generate report
     """
 
     args: dict = process_argv()
@@ -373,8 +1044,11 @@ def main():
     logger: logging.Logger = get_logger(config=config)
     log_fileinfo: Fileinfo = find_log(config=config, logger=logger)
     check_is_exist_report(config=config, log_fileinfo=log_fileinfo, logger=logger)
-    parsed_log: ParsedLog = parse_log(config=config, log_fileinfo=log_fileinfo, logger=logger)
-    processed_log: ProcessedLog = process_log(config=config, parsed_log=parsed_log)
+    processed_log: ProcessedLog = parse_and_aggregate(
+        config=config,
+        log_fileinfo=log_fileinfo,
+        logger=logger,
+    )
 
     generate_report(
         config=config,
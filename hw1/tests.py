@@ -1,11 +1,17 @@
 import gzip
+import io
 import json
 import logging
 import os
+import random
 import shutil
 import tempfile
 import unittest
+from array import array
 from datetime import datetime
+from pathlib import Path
+from statistics import median
+from unittest import mock
 
 import log_analyzer
 
@@ -20,6 +26,13 @@ CONFIG = {
 }
 
 
+def build_log_fixture(path: str, *, count: int, request_time: float) -> None:
+    """Write gzipped ui_short log of count equal lines to path"""
+    line = f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {request_time}\n'.encode()
+    with gzip.open(path, 'wb') as f:
+        f.write(line * count)
+
+
 class LogAnalyzerTests(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -33,22 +46,14 @@ class LogAnalyzerTests(unittest.TestCase):
             })
         cls.logger = logging.getLogger()
 
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210223.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210224.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210225.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210226.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210227.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210228.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210299.gz', 'w').close()
-        open(f'{cls.test_log_dir}/nginx-access-ui.log-20210399.gz', 'w').close()
+        dates = ('20210223', '20210224', '20210225', '20210226', '20210227', '20210228', '20210299', '20210399')
+        for date in dates:
+            Path(f'{cls.test_log_dir}/nginx-access-ui.log-{date}.gz').touch()
 
         cls.last_log_filename = f'{cls.test_log_dir}/nginx-access-ui.log-20210301.gz'
         cls.COUNT_LINES = 100
         cls.REQUEST_TIME = 555
-        with gzip.open(cls.last_log_filename, 'wb') as f:
-            line = f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {cls.REQUEST_TIME}\n'
-            for _ in range(cls.COUNT_LINES):
-                f.write(str.encode(line))
+        build_log_fixture(cls.last_log_filename, count=cls.COUNT_LINES, request_time=cls.REQUEST_TIME)
 
     @classmethod
     def tearDownClass(cls):
@@ -58,8 +63,10 @@ class LogAnalyzerTests(unittest.TestCase):
 
     def tearDown(self):
         report_path = f'{self.test_report_dir}/report-2021.03.01.html'
-        if os.path.exists(report_path):
+        try:
             os.remove(report_path)
+        except FileNotFoundError:
+            pass
 
     def test_get_config(self):
         new_config = {
@@ -99,6 +106,13 @@ class LogAnalyzerTests(unittest.TestCase):
         self.assertEqual(log_fileinfo['date'], datetime(2021, 3, 1))
         self.assertEqual(log_fileinfo['extension'], '.gz')
 
+        with tempfile.TemporaryDirectory() as log_dir:
+            """Check that date shorter than 8 digits is not parsed"""
+            Path(f'{log_dir}/nginx-access-ui.log-2021031').touch()
+            Path(f'{log_dir}/nginx-access-ui.log-20210228').touch()
+            last_log = log_analyzer.scan_log_dir(log_dir, ['', '.gz'])
+            self.assertEqual(last_log, ('nginx-access-ui.log-20210228', datetime(2021, 2, 28), ''))
+
         with self.assertRaises(FileNotFoundError):
             """Check wrong log dir"""
             config = log_analyzer.get_config(
@@ -110,6 +124,17 @@ class LogAnalyzerTests(unittest.TestCase):
             config = log_analyzer.get_config(config_dict={'LOG_DIR': self.test_wrong_log_dir})
             log_analyzer.find_log(config=config, logger=self.logger)
 
+    def test_find_log_plain(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            open(f'{log_dir}/nginx-access-ui.log-20210301', 'w').close()
+            open(f'{log_dir}/nginx-access-ui.log-20210302.bz2', 'w').close()
+            config = log_analyzer.get_config(config_dict={'LOG_DIR': log_dir})
+            log_fileinfo = log_analyzer.find_log(config=config, logger=self.logger)
+
+        self.assertEqual(log_fileinfo['path'], f'{log_dir}/nginx-access-ui.log-20210301')
+        self.assertEqual(log_fileinfo['date'], datetime(2021, 3, 1))
+        self.assertEqual(log_fileinfo['extension'], '')
+
     def test_check_is_exist_report(self):
         report_path = f'{self.test_report_dir}/report-2021.03.01.html'
         date = datetime(2021, 3, 1)
@@ -118,42 +143,290 @@ class LogAnalyzerTests(unittest.TestCase):
             date=date,
             extension='.gz',
         )
+        self.assertFalse(
+            log_analyzer.is_exist_report(config=self.config, log_fileinfo=log_fileinfo, logger=self.logger))
+        log_analyzer.check_is_exist_report(config=self.config, log_fileinfo=log_fileinfo, logger=self.logger)
+
+        open(report_path, 'w').close()
+        self.assertTrue(
+            log_analyzer.is_exist_report(config=self.config, log_fileinfo=log_fileinfo, logger=self.logger))
         with self.assertRaises(SystemExit):
             """Check already generated report"""
-            open(report_path, 'w').close()
             log_analyzer.check_is_exist_report(
                 config=self.config,
                 log_fileinfo=log_fileinfo,
                 logger=self.logger,
             )
 
-    def test_parse_log(self):
+    def test_parse_and_aggregate(self):
         log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
-        parsed_log = log_analyzer.parse_log(
-            config=self.config,
-            log_fileinfo=log_fileinfo,
+        for arrow in (False, True):
+            config = log_analyzer.get_config(config_dict={**self.config, 'ARROW': arrow})
+            with self.subTest(arrow=arrow):
+                processed_log = log_analyzer.parse_and_aggregate(
+                    config=config,
+                    log_fileinfo=log_fileinfo,
+                    logger=self.logger,
+                )
+
+                self.assertEqual(processed_log['total_count'], self.COUNT_LINES)
+                self.assertEqual(processed_log['total_time'], self.COUNT_LINES * self.REQUEST_TIME)
+                self.assertEqual(len(processed_log['data'].items()), 1)
+                processed_line = processed_log['data']['/api/v2/banner/25019354']
+                self.assertEqual(processed_line['count'], self.COUNT_LINES)
+                self.assertEqual(processed_line['time_sum'], self.COUNT_LINES * self.REQUEST_TIME)
+                self.assertEqual(processed_line['time_max'], self.REQUEST_TIME)
+                self.assertEqual(processed_line['time_med'], self.REQUEST_TIME)
+
+    def test_parse_and_aggregate_backend(self):
+        log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
+        for options, is_arrow in (
+            ({'ARROW': False}, False),
+            ({'ARROW': True}, log_analyzer.pyarrow is not None),
+            ({'ARROW': True, 'EXACT_MEDIAN': True}, False),
+            ({'ARROW': True, 'URL_SKETCH': True}, False),
+        ):
+            config = log_analyzer.get_config(config_dict={**self.config, 'WORKERS': 1, **options})
+            with self.subTest(**options), mock.patch.object(
+                    log_analyzer, 'aggregate_log_arrow', wraps=log_analyzer.aggregate_log_arrow) as arrow:
+                log_analyzer.parse_and_aggregate(config=config, log_fileinfo=log_fileinfo, logger=self.logger)
+                self.assertEqual(arrow.called, is_arrow)
+
+    @unittest.skipIf(log_analyzer.pyarrow is None, 'pyarrow is not installed')
+    def test_aggregate_log_arrow_malformed_lines(self):
+        line = (
+            b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" '
+            b'200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" '
+            b'"dc7161be3" 0.390\n')
+        lines = (
+            line,
+            line.replace(b'/api/v2/banner/25019354', b'/api/\xff'),
+            line.replace(b' 0.390', b' "-" 0.390'),
+        )
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, 'nginx-access-ui.log-20210301')
+            with open(path, 'wb') as f:
+                f.write(b''.join(lines))
+
+            config = log_analyzer.get_config(config_dict={**self.config, 'REPORT_SIZE': 0})
+            log_fileinfo = log_analyzer.Fileinfo(path=path, date=datetime(2021, 3, 1), extension='')
+            data = log_analyzer.aggregate_log_arrow(
+                config=config,
+                log_fileinfo=log_fileinfo,
+                logger=self.logger,
+            )
+        self.assertEqual(list(data), ['/api/v2/banner/25019354'])
+        self.assertEqual(data['/api/v2/banner/25019354']['count'], 1)
+
+    @mock.patch.object(log_analyzer, 'PARSE_CHUNK_SIZE', 1000)
+    def test_parse_and_aggregate_workers(self):
+        log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
+        for exact_median in (False, True):
+            processed_logs = []
+            for workers in (1, 2):
+                config = log_analyzer.get_config(
+                    config_dict={**self.config, 'WORKERS': workers, 'EXACT_MEDIAN': exact_median})
+                with self.subTest(exact_median=exact_median, workers=workers), mock.patch.object(
+                        log_analyzer, 'merge_tmp_data', wraps=log_analyzer.merge_tmp_data) as merge_tmp_data:
+                    processed_logs.append(
+                        log_analyzer.parse_and_aggregate(
+                            config=config,
+                            log_fileinfo=log_fileinfo,
+                            logger=self.logger,
+                        ))
+                    # fixture is split into many chunks, so partials with same url are merged
+                    self.assertGreater(merge_tmp_data.call_count, 2)
+
+            self.assertEqual(processed_logs[0], processed_logs[1])
+            processed_line = processed_logs[0]['data']['/api/v2/banner/25019354']
+            self.assertEqual(processed_line['count'], self.COUNT_LINES)
+            self.assertEqual(processed_line['time_med'], self.REQUEST_TIME)
+
+    def test_merge_tmp_data(self):
+        rng = random.Random(0)
+        values = [rng.uniform(0, 10) for _ in range(3 * log_analyzer.P2_EXACT_SIZE)]
+        parts = (values[:len(values) // 2], values[len(values) // 2:])
+        for exact in (False, True):
+            median_init, median_update = (
+                (log_analyzer.exact_init, array.append) if exact else
+                (log_analyzer.p2_init, log_analyzer.p2_update))
+            tmp_data = {}
+            for part in parts:
+                url_stats = [len(part), sum(part), max(part), median_init(part[0])]
+                for value in part[1:]:
+                    median_update(url_stats[3], value)
+                log_analyzer.merge_tmp_data(tmp_data, {'/url/': url_stats}, exact=exact)
+
+            with self.subTest(exact=exact):
+                url_stats = tmp_data['/url/']
+                self.assertEqual(url_stats[:3], [len(values), sum(parts[0]) + sum(parts[1]), max(values)])
+                median_value = log_analyzer.exact_median if exact else log_analyzer.p2_value
+                self.assertAlmostEqual(median_value(url_stats[3]), median(values), delta=0 if exact else 0.3)
+
+    def test_parse_and_aggregate_url_sketch(self):
+        log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
+        processed_logs = []
+        for url_sketch, workers in ((False, 1), (True, 1), (True, 2)):
+            config = log_analyzer.get_config(
+                config_dict={**self.config, 'WORKERS': workers, 'URL_SKETCH': url_sketch})
+            processed_logs.append(
+                log_analyzer.parse_and_aggregate(
+                    config=config,
+                    log_fileinfo=log_fileinfo,
+                    logger=self.logger,
+                ))
+
+        self.assertEqual(processed_logs[0], processed_logs[1])
+        self.assertEqual(processed_logs[0], processed_logs[2])
+
+    def test_parse_chunk_url_sketch(self):
+        line = (
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" '
+            '200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n')
+        chunk = (line.format(url='/frequent/', time=1.0) * 20 + line.format(url='/rare/', time=0.5)).encode()
+        sketch = array('d', bytes(8 * log_analyzer.SKETCH_DEPTH * log_analyzer.SKETCH_MIN_WIDTH))
+        log_analyzer.add_to_sketch(sketch, log_analyzer.sum_chunk_times(chunk))
+
+        tmp_data, count, terminated_count = log_analyzer.parse_chunk(
+            chunk,
             logger=self.logger,
+            sketch=sketch,
+            threshold=10,
         )
+        self.assertEqual(list(tmp_data), ['/frequent/'])
+        self.assertEqual(tmp_data['/frequent/'][:3], [20, 20.0, 1.0])
+        self.assertEqual((count, terminated_count), (21, 0))
+        self.assertEqual(log_analyzer.sketch_cardinality(sketch), 2)
+
+    def test_add_to_sketch(self):
+        line = (
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" '
+            '200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n')
+        times = {f'/api/v2/banner/{i}': i / 10 for i in range(1000)}
+        chunk = ''.join(line.format(url=url, time=time) for url, time in times.items()).encode()
+
+        width = 256
+        chunk_times = log_analyzer.sum_chunk_times(chunk)
+        self.assertEqual(chunk_times, times)
 
-        self.assertEqual(parsed_log['total_count'], self.COUNT_LINES)
-        self.assertEqual(parsed_log['total_time'], self.COUNT_LINES * self.REQUEST_TIME)
-        self.assertEqual(len(parsed_log['parsed_lines']), self.COUNT_LINES)
-        self.assertEqual(parsed_log['parsed_lines'][0]['request_time'], self.REQUEST_TIME)
+        sketch = array('d', bytes(8 * log_analyzer.SKETCH_DEPTH * width))
+        log_analyzer.add_to_sketch(sketch, chunk_times)
+        for url, time in times.items():
+            estimate = min(sketch[i] for i in log_analyzer.sketch_indexes(url, width))
+            self.assertGreaterEqual(estimate, time)
 
-    def test_process_log(self):
+    def test_parse_and_aggregate_exact_median(self):
         log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
-        parsed_log = log_analyzer.parse_log(
-            config=self.config,
+        config = log_analyzer.get_config(config_dict={**self.config, 'EXACT_MEDIAN': True})
+        processed_log = log_analyzer.parse_and_aggregate(
+            config=config,
             log_fileinfo=log_fileinfo,
             logger=self.logger,
         )
 
-        processed_log = log_analyzer.process_log(config=self.config, parsed_log=parsed_log)
-        self.assertEqual(processed_log['total_count'], self.COUNT_LINES)
-        self.assertEqual(processed_log['total_time'], self.COUNT_LINES * self.REQUEST_TIME)
-        self.assertEqual(len(processed_log['data'].items()), 1)
-        processed_line = list(processed_log['data'].values())[0]
-        self.assertEqual(processed_line['time_sum'], self.COUNT_LINES * self.REQUEST_TIME)
+        processed_line = processed_log['data']['/api/v2/banner/25019354']
+        self.assertEqual(processed_line['count'], self.COUNT_LINES)
+        self.assertEqual(processed_line['time_med'], self.REQUEST_TIME)
+
+    def test_exact_median(self):
+        rng = random.Random(0)
+        for numpy in {None, log_analyzer.numpy}:
+            with self.subTest(numpy=numpy), mock.patch.object(log_analyzer, 'numpy', numpy):
+                for size in (1, 2, 5, 100, 101):
+                    values = [rng.uniform(0, 10) for _ in range(size)]
+                    self.assertAlmostEqual(
+                        log_analyzer.exact_median(array('d', values)), median(values))
+                    self.assertAlmostEqual(log_analyzer.exact_median(values), median(values))
+
+    def test_url_cardinality(self):
+        config = log_analyzer.get_config(config_dict={'REPORT_DIR': self.test_wrong_log_dir})
+        self.assertEqual(log_analyzer.load_url_cardinality(config=config), 0)
+
+        log_analyzer.save_url_cardinality(config=config, cardinality=42)
+        self.assertEqual(log_analyzer.load_url_cardinality(config=config), 42)
+
+        log_analyzer.save_url_cardinality(config=config, cardinality=10**12)
+        self.assertEqual(
+            log_analyzer.load_url_cardinality(config=config), log_analyzer.URL_CARDINALITY_MAX)
+        os.remove(os.path.join(self.test_wrong_log_dir, log_analyzer.URL_CARDINALITY_FILENAME))
+
+        log_fileinfo = log_analyzer.find_log(config=self.config, logger=self.logger)
+        for url_sketch in (False, True):
+            config = log_analyzer.get_config(
+                config_dict={**self.config, 'REPORT_DIR': self.test_wrong_log_dir, 'URL_SKETCH': url_sketch})
+            log_analyzer.parse_and_aggregate(config=config, log_fileinfo=log_fileinfo, logger=self.logger)
+            self.assertEqual(log_analyzer.load_url_cardinality(config=config), int(url_sketch))
+        os.remove(os.path.join(self.test_wrong_log_dir, log_analyzer.URL_CARDINALITY_FILENAME))
+
+    def test_parse_line(self):
+        line = (
+            b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" '
+            b'200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" '
+            b'"dc7161be3" 0.390')
+        self.assertEqual(log_analyzer.parse_line(line), ('/api/v2/banner/25019354', 0.390))
+
+        for wrong_line in (
+            b'',
+            b'garbage line',
+            line.replace(b'"GET /api/v2/banner/25019354 HTTP/1.1"', b'"-"'),
+            line.replace(b' 0.390', b' -'),
+            line.replace(b'/api/v2/banner/25019354', b'/api/\xff'),
+        ):
+            self.assertIsNone(log_analyzer.parse_line(wrong_line))
+
+    def test_open_gz(self):
+        with gzip.open(self.last_log_filename, 'rb') as f:
+            expected = f.read()
+
+        backends = [('gzip', None, None)]
+        if log_analyzer.igzip:
+            backends.append(('igzip', None, log_analyzer.igzip))
+        if log_analyzer.rapidgzip:
+            backends.append(('rapidgzip', log_analyzer.rapidgzip, None))
+        for backend, rapidgzip, igzip in backends:
+            with self.subTest(backend=backend), mock.patch.multiple(log_analyzer, rapidgzip=rapidgzip, igzip=igzip):
+                with log_analyzer.open_gz(self.last_log_filename) as f:
+                    self.assertEqual(f.read(), expected)
+
+    def test_iter_chunks(self):
+        f = io.BytesIO(b'first line\nsecond line\nthird line\n')
+        chunks = list(log_analyzer.iter_chunks(f, 3))
+        self.assertEqual(chunks, [b'first line\n', b'second line\n', b'third line\n'])
+
+    def test_iter_chunk_bounds(self):
+        data = b'first line\nsecond line\nthird line'
+        bounds = list(log_analyzer.iter_chunk_bounds(data, 3))
+        chunks = [data[start:end] for start, end in bounds]
+        self.assertEqual(chunks, [b'first line\n', b'second line\n', b'third line'])
+        self.assertEqual(list(log_analyzer.iter_chunk_bounds(b'', 3)), [])
+
+    def test_p2_median(self):
+        rng = random.Random(0)
+        values = [rng.uniform(0, 10) for _ in range(10000)]
+        state = log_analyzer.p2_init(values[0])
+        exact_size = log_analyzer.P2_EXACT_SIZE - 1
+        for value in values[1:exact_size]:
+            log_analyzer.p2_update(state, value)
+        self.assertEqual(log_analyzer.p2_value(state), median(values[:exact_size]))
+
+        for value in values[exact_size:]:
+            log_analyzer.p2_update(state, value)
+        self.assertAlmostEqual(log_analyzer.p2_value(state), median(values), delta=0.2)
+
+        other = log_analyzer.p2_init(values[0])
+        for value in values[1:]:
+            log_analyzer.p2_update(other, value)
+        log_analyzer.p2_merge(state, other)
+        self.assertAlmostEqual(log_analyzer.p2_value(state), median(values), delta=0.2)
+
+    def test_dump_json(self):
+        obj = [{'url': '/test-url/', 'count': 1, 'time_sum': 5.5}]
+        for orjson in {None, log_analyzer.orjson}:
+            with self.subTest(orjson=orjson), mock.patch.object(log_analyzer, 'orjson', orjson):
+                self.assertEqual(
+                    log_analyzer.dump_json(obj),
+                    b'[{"url":"/test-url/","count":1,"time_sum":5.5}]',
+                )
 
     def test_generate_report(self):
         TOTAL_COUNT = 1
@@ -164,7 +437,7 @@ class LogAnalyzerTests(unittest.TestCase):
             time_sum=TIME,
             time_avg=TIME,
             time_max=TIME,
-            time_list=[TIME, TIME],
+            time_med=TIME,
         )
         DATA = {'/test-url/': PROCESSED_LINE}
 
@@ -195,19 +468,18 @@ class LogAnalyzerTests(unittest.TestCase):
             log_fileinfo=log_fileinfo,
             logger=self.logger,
         )
-        table_json = json.dumps(
-            [
-                {
-                    'url': PROCESSED_LINE['url'],
-                    'count': PROCESSED_LINE['count'],
-                    'count_perc': 100.0,
-                    'time_sum': PROCESSED_LINE['time_sum'],
-                    'time_perc': 100.0,
-                    'time_avg': PROCESSED_LINE['time_avg'],
-                    'time_max': PROCESSED_LINE['time_max'],
-                    'time_med': TIME,
-                }
-            ])
+        table = [
+            {
+                'url': PROCESSED_LINE['url'],
+                'count': PROCESSED_LINE['count'],
+                'count_perc': 100.0,
+                'time_sum': PROCESSED_LINE['time_sum'],
+                'time_perc': 100.0,
+                'time_avg': PROCESSED_LINE['time_avg'],
+                'time_max': PROCESSED_LINE['time_max'],
+                'time_med': TIME,
+            }
+        ]
 
         report_fileinfo = log_analyzer.generate_report_filename(
             config=self.config,
@@ -216,7 +488,7 @@ class LogAnalyzerTests(unittest.TestCase):
 
         with open(report_fileinfo['path'], 'r') as f:
             line = f.read()
-            self.assertEqual(line, table_json)
+            self.assertEqual(json.loads(line), table)
 
 
 if __name__ == '__main__':